@@ -1,23 +1,74 @@
 #!/usr/bin/env python3
 import os
 import sys
+import stat
 import tempfile
 import subprocess
 import shutil
-from typing import Optional, TypedDict, Any, IO
+import errno
+import contextlib
+import io
+import hashlib
+import base64
+import re
+import queue
+import threading
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, TypedDict, Any, IO, Callable, Sequence, Iterator, cast
 import urllib.request
 from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit, unquote, SplitResult
 from pathlib import Path
 import tomllib  # stdlib as of Python 3.11
 
 import click
 
+try:
+    # Optional: Aho-Corasick automaton for --replace (pip install pyahocorasick)
+    import ahocorasick  # type: ignore[import-not-found]
+except ImportError:
+    ahocorasick = None
+
 DEFAULT_DOCKER_ROOT = "/var/lib/docker"
 DEFAULT_TRANSFERSH = "https://transfer.sh"
 
 CONFIG_DIR = Path("~/.dvm").expanduser()
 CONFIG_PATH = CONFIG_DIR / "config.toml"
 
+# Set DVM_VERBOSE=1 to log the tar command lines that are run
+VERBOSE = bool(os.environ.get("DVM_VERBOSE"))
+
+# Block size for streaming up-/downloads and how many blocks may be read ahead
+CHUNK_SIZE = 4 << 20
+UPLOAD_QUEUE_DEPTH = 4
+
+# Seconds a single socket operation may block (not the whole transfer).
+# Not applied while waiting for an upload's response: the server may
+# still be moving the whole archive to its storage backend.
+HTTP_TIMEOUT = 300
+
+# Idle upload connections are reused for this many seconds, then dropped
+# before the server is likely to have closed them
+POOL_IDLE_TIMEOUT = 15
+
+# Archives are compressed on the fly; zstd frames start with these bytes
+COMPRESSION_CHOICES = ["zstd", "none", "raw"]
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Backup URLs carry the archive's SHA-256 in their fragment (never sent to
+# the server), which restore verifies while extracting
+CHECKSUM_PREFIX = "sha256="
+
+# Upper bound for the default --jobs; every job runs its own tar/zstd and
+# holds several CHUNK_SIZE buffers
+MAX_DEFAULT_JOBS = 4
+
+# Multi-volume backups upload one archive (shard) per volume plus a manifest
+# listing "<volume> <url>" per line below this header
+MANIFEST_HEADER = b"# dvm manifest v1\n"
+
 
 # ---------------------------------------------------------------------------
 # Helper functions: permissions, tar, HTTP
@@ -44,55 +95,117 @@ def stdout(message: str, **kwargs: Any) -> None:
     echo(message, err=False, **kwargs)
 
 
+def log_command(what: str, cmd: list[str]) -> None:
+    """
+    Log a command line to STDERR, only in verbose mode.
+    """
+    if VERBOSE:
+        sys.stderr.write(f"{what}: {' '.join(cmd)}\n")
+
+
 def ensure_root():
     if os.geteuid() != 0:
         echo("This command must be run as root (sudo ...).", err=True)
         sys.exit(1)
 
 
-def run_tar_create(tar_path: str, volumes_dir: str, volume_names: list[str]) -> None:
+def default_jobs() -> int:
     """
-    Create a tar archive with the given volume directories.
+    Default for --jobs: one per CPU, but at most MAX_DEFAULT_JOBS.
+    """
+    return min(MAX_DEFAULT_JOBS, os.cpu_count() or 1)
 
-    Archive structure:
-        vol1/...
-        vol2/...
 
-    => Restore is done with -C <volumes_dir>.
+def compress_args(
+    compression: str, extract: bool = False, threads: int = 0
+) -> list[str]:
+    """
+    tar arguments for the given compression ("none" and "raw" add nothing).
+
+    threads is passed to zstd -T (0: one per core).
+    """
+    if compression != "zstd":
+        return []
+    if shutil.which("zstd") is None:
+        raise click.ClickException(
+            "zstd is not installed. Install it or use --compression none."
+        )
+    if extract:
+        return ["--use-compress-program=zstd -d"]
+    return [f"--use-compress-program=zstd -T{threads} -3 --long"]
+
+
+def list_volume_dirs(volumes_dir: str) -> set[str]:
+    """
+    Names of all directories directly under volumes_dir, i.e. one per
+    Docker volume (metadata.db and other files are skipped, as are hidden
+    directories such as restore's .dvm-restore-* temp dirs; Docker volume
+    names never start with a dot).
     """
     if not os.path.isdir(volumes_dir):
         raise click.ClickException(
             f"Volumes directory does not exist: {volumes_dir}"
         )
 
-    # Check whether the volume folders exist
-    missing = [
-        v for v in volume_names if not os.path.isdir(os.path.join(volumes_dir, v))
-    ]
+    with os.scandir(volumes_dir) as entries:
+        return {
+            e.name
+            for e in entries
+            if not e.name.startswith(".") and e.is_dir(follow_symlinks=False)
+        }
+
+
+def check_volume_dirs(volumes_dir: str, volume_names: list[str]) -> None:
+    """
+    Make sure the volumes directory and all given volume folders exist.
+    """
+    # One directory scan instead of a stat() per volume
+    existing = list_volume_dirs(volumes_dir)
+    missing = [v for v in volume_names if v not in existing]
     if missing:
         raise click.ClickException(
             "The following volume directories are missing under "
             f"{volumes_dir}: {', '.join(missing)}"
         )
 
+
+def run_tar_create(
+    volumes_dir: str,
+    volume_names: list[str],
+    compression: str = "none",
+    threads: int = 0,
+) -> "subprocess.Popen[bytes]":
+    """
+    Start tar writing an archive of the given volume directories to stdout.
+
+    Archive structure:
+        vol1/...
+        vol2/...
+
+    => Restore is done with -C <volumes_dir>.
+    """
     cmd = [
         "tar",
         "--xattrs",
         "--acls",
         "--numeric-owner",
+        *compress_args(compression, threads=threads),
         "-C",
         volumes_dir,
         "-cpf",
-        tar_path,
+        "-",
         *volume_names,
     ]
-    echo(f"Creating tar archive with: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
+    log_command("Creating tar archive with", cmd)
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
 
 
-def run_tar_extract(tar_path: str, volumes_dir: str) -> None:
+def run_tar_extract(
+    volumes_dir: str, compression: str = "none"
+) -> "subprocess.Popen[bytes]":
     """
-    Extract a tar archive into the Docker volumes directory.
+    Start tar extracting an archive read from stdin into the Docker volumes
+    directory.
     """
     if not os.path.isdir(volumes_dir):
         raise click.ClickException(
@@ -104,75 +217,675 @@ def run_tar_extract(tar_path: str, volumes_dir: str) -> None:
         "--xattrs",
         "--acls",
         "--numeric-owner",
+        *compress_args(compression, extract=True),
         "-C",
         volumes_dir,
         "-xpf",
-        tar_path,
+        "-",
     ]
-    echo(f"Extracting tar archive with: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
+    log_command("Extracting tar archive with", cmd)
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=CHUNK_SIZE)
 
 
-def upload_to_transfersh(
-    file_path: str,
-    endpoint: str,
-    name: str | None = None,
-    max_days: int | None = None,
+def with_checksum(url: str, digest: "hashlib._Hash") -> str:
+    """
+    Append digest to url as fragment, e.g. https://.../name#sha256=<hex>.
+    """
+    return f"{url}#{CHECKSUM_PREFIX}{digest.hexdigest()}"
+
+
+def split_checksum(url: str) -> tuple[str, Optional[str]]:
+    """
+    Split a URL from with_checksum() into plain URL and hex digest (if any).
+    """
+    url, _, fragment = url.partition("#")
+    if fragment.startswith(CHECKSUM_PREFIX):
+        return url, fragment.removeprefix(CHECKSUM_PREFIX)
+    return url, None
+
+
+def _read_chunks(
+    f: io.BufferedIOBase,
+    chunks: "queue.Queue[memoryview | BaseException | None]",
+    free: "queue.Queue[bytearray]",
+    digest: "hashlib._Hash | None",
+) -> None:
+    """
+    Producer for put_chunked(): read f block by block into the queue.
+
+    Blocks are read into buffers taken from free, which the consumer hands
+    back once sent, so no new bytes objects are allocated per block.
+    None marks the end of the stream, an exception is handed over as-is.
+    Hashing happens here as well, so it overlaps with sending.
+    """
+    try:
+        while True:
+            buf = free.get()
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = memoryview(buf)[:n]
+            if digest is not None:
+                digest.update(chunk)
+            chunks.put(chunk)
+    except BaseException as e:
+        chunks.put(e)
+    else:
+        chunks.put(None)
+
+
+# Idle keep-alive connections per (scheme, host:port) with their release time
+_idle_connections: dict[
+    tuple[str, str], list[tuple[http.client.HTTPConnection, float]]
+] = {}
+_idle_lock = threading.Lock()
+
+
+def upload_proxy(parts: SplitResult) -> tuple[Optional[SplitResult], dict[str, str]]:
+    """
+    Proxy to use for the host of parts according to the *_proxy/no_proxy
+    environment variables (as urllib does for downloads), plus the
+    Proxy-Authorization header for credentials in the proxy URL.
+    """
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.hostname or ""):
+        return None, {}
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+
+    proxy_parts = urlsplit(proxy)
+    proxy_headers: dict[str, str] = {}
+    if proxy_parts.username is not None:
+        credentials = (
+            f"{unquote(proxy_parts.username)}:{unquote(proxy_parts.password or '')}"
+        )
+        proxy_headers["Proxy-Authorization"] = (
+            f"Basic {base64.b64encode(credentials.encode()).decode()}"
+        )
+    return proxy_parts, proxy_headers
+
+
+@contextlib.contextmanager
+def pooled_connection(parts: SplitResult) -> Iterator[http.client.HTTPConnection]:
+    """
+    Borrow a keep-alive connection to the host of parts (or to its proxy,
+    see upload_proxy()).
+
+    Shard uploads and the manifest thereby share TCP connections and TLS
+    handshakes. The connection is handed back on success and closed on
+    errors.
+    """
+    key = (parts.scheme, parts.netloc)
+    conn = None
+    with _idle_lock:
+        idle = _idle_connections.setdefault(key, [])
+        while idle and conn is None:
+            candidate, released = idle.pop()
+            if time.monotonic() - released < POOL_IDLE_TIMEOUT:
+                conn = candidate
+            else:
+                candidate.close()
+
+    if conn is None:
+        conn_cls = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        proxy, proxy_headers = upload_proxy(parts)
+        if proxy is None:
+            conn = conn_cls(parts.netloc, timeout=HTTP_TIMEOUT)
+        else:
+            proxy_port = proxy.port or (443 if proxy.scheme == "https" else 80)
+            conn = conn_cls(proxy.hostname or "", proxy_port, timeout=HTTP_TIMEOUT)
+            if parts.scheme == "https":
+                # CONNECT through the proxy, TLS is then spoken with the host
+                conn.set_tunnel(parts.hostname or "", parts.port, proxy_headers)
+
+    try:
+        yield conn
+    except BaseException:
+        conn.close()
+        raise
+
+    with _idle_lock:
+        _idle_connections[key].append((conn, time.monotonic()))
+
+
+def put_chunked(
+    url: str,
+    f: io.BufferedIOBase,
+    headers: dict[str, str],
+    digest: "hashlib._Hash | None" = None,
+    check_input: Optional[Callable[[], None]] = None,
 ) -> str:
     """
-    Uploads file_path via HTTP PUT to a transfer.sh-compatible endpoint.
+    Stream f via HTTP PUT with chunked transfer encoding and return the body.
 
-    Roughly equivalent to:
-        curl --upload-file file_path https://transfer.sh/name
+    A background thread reads the next blocks while the current one is
+    being sent, so reading and network writes overlap. If given, digest is
+    updated with everything sent. The connection comes from
+    pooled_connection().
+
+    check_input is called once f is exhausted; if it raises, the connection
+    is dropped without the terminating chunk, so the server discards the
+    incomplete upload.
     """
-    if name is None:
-        name = os.path.basename(file_path)
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path = f"{path}?{parts.query}"
+
+    # Plain HTTP proxies get the absolute URL, HTTPS ones are tunnelled
+    proxy, proxy_headers = upload_proxy(parts)
+    if proxy is not None and parts.scheme == "http":
+        path = f"http://{parts.netloc}{path}"
+        headers = {**proxy_headers, **headers}
+
+    chunks: queue.Queue[memoryview | BaseException | None] = queue.Queue(
+        maxsize=UPLOAD_QUEUE_DEPTH
+    )
+    # Enough buffers for a full queue, the block being sent and the one
+    # being read
+    free: queue.Queue[bytearray] = queue.Queue()
+    for _ in range(UPLOAD_QUEUE_DEPTH + 2):
+        free.put(bytearray(CHUNK_SIZE))
+    producer = threading.Thread(
+        target=_read_chunks, args=(f, chunks, free, digest), daemon=True
+    )
 
-    base = endpoint.rstrip("/")
-    url = f"{base}/{name}"
+    with pooled_connection(parts) as conn:
+        conn.putrequest("PUT", path)
+        conn.putheader("Transfer-Encoding", "chunked")
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders()
+
+        producer.start()
+        while (chunk := chunks.get()) is not None:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            conn.send(b"%x\r\n" % len(chunk))
+            conn.send(chunk)
+            conn.send(b"\r\n")
+            free.put(cast(bytearray, chunk.obj))
+        if check_input is not None:
+            check_input()
+        conn.send(b"0\r\n\r\n")
+
+        assert conn.sock is not None
+        conn.sock.settimeout(None)
+        resp = conn.getresponse()
+        body = resp.read().decode().strip()
+        if conn.sock is not None:
+            # Kept alive for the next upload
+            conn.sock.settimeout(HTTP_TIMEOUT)
+
+    # Anything but 2xx is an error, redirects included (as with urllib)
+    if not 200 <= resp.status < 300:
+        raise click.ClickException(
+            f"Upload failed: HTTP {resp.status} - {resp.reason}"
+        )
+    return body
+
+
+def stream_tar_to_http(
+    volumes_dir: str,
+    volume_names: list[str],
+    url: str,
+    headers: dict[str, str],
+    compression: str = "none",
+    threads: int = 0,
+) -> str:
+    """
+    Pipe tar's output straight into an HTTP PUT to url.
+
+    Roughly equivalent to:
+        tar -cpf - vol1 vol2 | curl --upload-file - https://transfer.sh/name
+
+    No temporary archive is written, and tar keeps packing while the
+    previous blocks are on the wire. Returns the URL with the archive's
+    checksum appended (see with_checksum()).
+    """
+    proc = run_tar_create(volumes_dir, volume_names, compression, threads)
+    assert proc.stdout is not None
 
     echo(f"Uploading archive to {url} ...")
 
-    req = urllib.request.Request(url, method="PUT")
-    if max_days is not None:
-        # transfer.sh supports e.g. Max-Days as header (depending on implementation)
-        req.add_header("Max-Days", str(max_days))
+    def check_tar() -> None:
+        # tar closed its stdout, so it is about to exit
+        returncode = proc.wait()
+        if returncode != 0:
+            raise click.ClickException(f"tar failed with exit code {returncode}")
+
+    try:
+        digest = hashlib.sha256()
+        body = put_chunked(
+            url, cast(io.BufferedIOBase, proc.stdout), headers, digest, check_tar
+        )
+    except (OSError, http.client.HTTPException) as e:
+        proc.kill()
+        raise click.ClickException(f"Upload failed: {e}")
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise click.ClickException(f"tar failed with exit code {returncode}")
+    return with_checksum(body, digest)
+
 
-    with open(file_path, "rb") as f:
+def split_archive_name(name: str) -> tuple[str, str]:
+    """
+    Split an archive name into stem and suffix, e.g.
+    "docker-volumes.tar.zst" -> ("docker-volumes", ".tar.zst").
+    """
+    for suffix in (".tar.zst", ".tar"):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)], suffix
+    return name, ""
+
+
+def run_parallel(
+    func: Callable[..., Any], calls: Sequence[Sequence[Any]], jobs: int
+) -> list[Any]:
+    """
+    Run func(*args) for every args in calls, `jobs` at a time, and return the
+    results in order.
+
+    The first failure cancels everything not yet started before it is
+    re-raised; calls already running are still waited for.
+    """
+    failed = threading.Event()
+
+    def call(args: Sequence[Any]) -> Any:
+        # A worker freed by a failure may pick up the next call before the
+        # pool is shut down. Skipped calls come after the failed one, so
+        # their results are never looked at.
+        if failed.is_set():
+            return None
         try:
-            with urllib.request.urlopen(req, data=f) as resp:
-                body = resp.read().decode().strip()
-        except HTTPError as e:
-            raise click.ClickException(
-                f"Upload failed: HTTP {e.code} - {e.reason}"
+            return func(*args)
+        except BaseException:
+            failed.set()
+            raise
+
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [pool.submit(call, args) for args in calls]
+        return [future.result() for future in futures]
+    except BaseException:
+        pool.shutdown(cancel_futures=True)
+        raise
+    finally:
+        pool.shutdown()
+
+
+def stream_shards_to_http(
+    volumes_dir: str,
+    volume_names: list[str],
+    endpoint: str,
+    name: str,
+    headers: dict[str, str],
+    compression: str,
+    jobs: int,
+) -> str:
+    """
+    Upload one archive per volume in parallel, then a manifest listing them.
+
+    Shards are named <stem>.partNN<suffix>, the manifest <stem>.manifest.
+    Returns the URL of the manifest, which restore accepts like an archive.
+    The cores are split between the parallel zstd processes.
+    """
+    base = endpoint.rstrip("/")
+    stem, suffix = split_archive_name(name)
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+
+    urls = run_parallel(
+        stream_tar_to_http,
+        [
+            (
+                volumes_dir,
+                [volume],
+                f"{base}/{stem}.part{i:02d}{suffix}",
+                headers,
+                compression,
+                threads,
             )
-        except URLError as e:
-            raise click.ClickException(f"Upload failed: {e.reason}")
+            for i, volume in enumerate(volume_names, start=1)
+        ],
+        jobs,
+    )
 
-    echo("Upload complete.")
-    echo(f"Response: {body}")
-    return str(body)
+    manifest = MANIFEST_HEADER + "".join(
+        f"{volume} {url}\n" for volume, url in zip(volume_names, urls)
+    ).encode()
+
+    url = f"{base}/{stem}.manifest"
+    echo(f"Uploading manifest to {url} ...")
+    try:
+        body = put_chunked(url, io.BytesIO(manifest), headers)
+    except (OSError, http.client.HTTPException) as e:
+        raise click.ClickException(f"Upload failed: {e}")
+    return with_checksum(body, hashlib.sha256(manifest))
 
 
-def download_file(url: str, dest_path: str) -> None:
+def open_download(url: str) -> tuple[http.client.HTTPResponse, str, Optional[str]]:
     """
-    Download a file via HTTP GET.
+    Open url for downloading.
+
+    Returns the response, the URL without checksum fragment and the
+    expected checksum from it (see with_checksum()), if any.
     """
+    url, expected = split_checksum(url)
+    if expected is None:
+        echo("No checksum in URL, the download will not be verified.")
+
     echo(f"Downloading {url} ...")
+    # Ask for the archive as-is, it is piped to tar without decoding
+    req = urllib.request.Request(url, headers={"Accept-Encoding": "identity"})
     try:
-        with urllib.request.urlopen(url) as resp, open(dest_path, "wb") as out:
-            while True:
-                chunk = resp.read(1024 * 1024)
-                if not chunk:
-                    break
-                out.write(chunk)
+        resp = urllib.request.urlopen(req, timeout=HTTP_TIMEOUT)
     except HTTPError as e:
         raise click.ClickException(
             f"Download failed: HTTP {e.code} - {e.reason}"
         )
     except URLError as e:
         raise click.ClickException(f"Download failed: {e.reason}")
-    echo(f"Download saved to: {dest_path}")
+    return resp, url, expected
+
+
+def is_volume_name(name: str) -> bool:
+    """
+    Whether name is usable as a single directory under volumes_dir.
+    """
+    return name not in ("", ".", "..") and os.sep not in name
+
+
+def parse_manifest(data: bytes) -> list[tuple[str, str]]:
+    """
+    (volume, url) entries of a manifest, header line included in data.
+    """
+    entries = []
+    for line in data.decode().splitlines()[1:]:
+        if not line.strip():
+            continue
+        fields = line.split()
+        if len(fields) != 2 or not is_volume_name(fields[0]):
+            raise click.ClickException(f"Invalid manifest line: {line!r}")
+        entries.append((fields[0], fields[1]))
+    return entries
+
+
+def read_manifest(
+    resp: http.client.HTTPResponse, head: bytes, url: str, expected: Optional[str]
+) -> list[tuple[str, str]]:
+    """
+    Read the rest of a manifest whose header is already in head, verify
+    and parse it.
+    """
+    data = head + resp.read()
+    verify_checksum(url, expected, hashlib.sha256(data))
+    return parse_manifest(data)
+
+
+def stream_http_to_tar(url: str, volumes_dir: str, jobs: int = 1) -> None:
+    """
+    Download url and pipe the response straight into tar.
+
+    Roughly equivalent to:
+        curl https://transfer.sh/.../name | tar -xpf -
+
+    No temporary archive is written, and tar extracts while the rest of
+    the archive is still downloading. zstd-compressed archives are
+    recognized by their magic bytes. If url points to a manifest, its
+    shards are downloaded and extracted with up to `jobs` in parallel.
+
+    If url carries a checksum (see with_checksum()), the download is hashed
+    on the way through and verified.
+    """
+    resp, url, expected = open_download(url)
+    with resp:
+        head = resp.read(len(MANIFEST_HEADER))
+        if head != MANIFEST_HEADER:
+            pipe_response_to_tar(resp, head, volumes_dir, url, expected)
+            return
+        entries = read_manifest(resp, head, url, expected)
+
+    echo(f"Manifest lists {len(entries)} archives.")
+    stream_shards_to_tar([shard_url for _, shard_url in entries], volumes_dir, jobs)
+
+
+def stream_shards_to_tar(urls: list[str], volumes_dir: str, jobs: int) -> None:
+    """
+    Run stream_http_to_tar() for every url, `jobs` at a time.
+    """
+    run_parallel(stream_http_to_tar, [(url, volumes_dir) for url in urls], jobs)
+
+
+def verify_checksum(url: str, expected: Optional[str], digest: "hashlib._Hash") -> None:
+    """
+    Compare the digest of a finished download with the one from its URL.
+    """
+    if expected is None:
+        return
+    if digest.hexdigest() != expected.lower():
+        raise click.ClickException(
+            f"Checksum mismatch for {url}: expected {expected}, "
+            f"got {digest.hexdigest()}. The restored data may be corrupt!"
+        )
+    echo(f"Checksum verified: {url}")
+
+
+def pipe_response_to_tar(
+    resp: http.client.HTTPResponse,
+    head: bytes,
+    volumes_dir: str,
+    url: str,
+    expected: Optional[str],
+) -> None:
+    """
+    Feed an HTTP response, whose first bytes were already read into head,
+    into tar, hashing it on the way for verify_checksum().
+    """
+    compression = "zstd" if head.startswith(ZSTD_MAGIC) else "none"
+    proc = run_tar_extract(volumes_dir, compression)
+    assert proc.stdin is not None
+
+    digest = hashlib.sha256(head)
+    # One reusable buffer instead of a new bytes object per block
+    buf = memoryview(bytearray(CHUNK_SIZE))
+    try:
+        proc.stdin.write(head)
+        while n := resp.readinto(buf):
+            digest.update(buf[:n])
+            proc.stdin.write(buf[:n])
+    except BrokenPipeError:
+        # tar exited early, its exit code below tells why
+        pass
+    except (OSError, http.client.HTTPException) as e:
+        proc.kill()
+        raise click.ClickException(f"Download failed: {e}")
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            proc.stdin.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise click.ClickException(f"tar failed with exit code {returncode}")
+    echo("Download extracted.")
+    verify_checksum(url, expected, digest)
+
+
+def compile_replacements(replace_pairs: list[tuple[str, str]]) -> Callable[[str], str]:
+    """
+    Build a function applying all (old, new) pairs to a name in one pass.
+
+    Where several olds match at the same position the longest wins; if an
+    old is given twice, its first replacement is used. With pyahocorasick
+    installed, names are scanned by an Aho-Corasick automaton in time
+    linear in their length regardless of the number of rules, otherwise by
+    a single regex alternation.
+    """
+    repl: dict[str, str] = {}
+    for old, new in replace_pairs:
+        repl.setdefault(old, new)
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for old, new in repl.items():
+            automaton.add_word(old, (len(old), new))
+        automaton.make_automaton()
+        return lambda name: _replace_matches(name, automaton)
+
+    pattern = re.compile(
+        "|".join(re.escape(old) for old in sorted(repl, key=len, reverse=True))
+    )
+    return lambda name: pattern.sub(lambda m: repl[m.group(0)], name)
+
+
+def _replace_matches(name: str, automaton: Any) -> str:
+    """
+    Replace the leftmost-longest non-overlapping automaton hits in name,
+    like the regex fallback of compile_replacements() does.
+    """
+    hits = sorted(
+        (end - length + 1, -length, new)
+        for end, (length, new) in automaton.iter(name)
+    )
+
+    parts: list[str] = []
+    pos = 0
+    for start, neg_length, new in hits:
+        if start < pos:
+            continue
+        parts.append(name[pos:start])
+        parts.append(new)
+        pos = start - neg_length
+    parts.append(name[pos:])
+    return "".join(parts)
+
+
+def confirm_target(volumes_dir: str, name: str, new_name: str, force: bool) -> bool:
+    """
+    Check whether volume name may be restored as new_name under volumes_dir.
+
+    An existing target needs confirmation (or force); nothing is removed
+    here, see replace_target(). Returns False if the volume should be
+    skipped.
+    """
+    if not is_volume_name(new_name):
+        raise click.ClickException(
+            f"Invalid target volume name {new_name!r} for volume '{name}'."
+        )
+    dst = os.path.join(volumes_dir, new_name)
+
+    if os.path.lexists(dst):
+        echo(
+            f"Warning: Target volume directory already exists: {dst}",
+        )
+        if not force and not click.confirm("Overwrite?", default=False):
+            echo(f"Skipping volume '{name}'.")
+            return False
+        echo(f"Overwriting existing volume directory '{dst}'.")
+
+    echo(
+        f"Volume directory '{name}' -> '{new_name}'",
+    )
+    return True
+
+
+def replace_target(src: str, dst: str) -> None:
+    """
+    Move a fully extracted volume src to dst, replacing what is there.
+    """
+    if os.path.lexists(dst):
+        remove_target(dst)
+    move_dir(src, dst)
+
+
+def remove_target(dst: str) -> None:
+    """
+    Remove an existing restore target, be it a directory, file or symlink.
+    """
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    else:
+        os.unlink(dst)
+
+
+def move_dir(src: str, dst: str) -> None:
+    """
+    Move src to dst: an atomic rename on the same filesystem, a copy
+    otherwise.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def restore_renamed(
+    url: str,
+    volumes_dir: str,
+    rename: Callable[[str], str],
+    force: bool,
+    jobs: int,
+) -> None:
+    """
+    Restore url under volumes_dir, renaming every volume with rename.
+
+    Volumes are extracted into a hidden temp dir next to their targets and
+    only moved into place (replacing a confirmed existing volume) once their
+    tar has succeeded, so a failed download never costs the old volume.
+
+    A manifest names every volume up front: prompts come before anything is
+    downloaded, and skipped volumes are not downloaded at all.
+    """
+    resp, url, expected = open_download(url)
+    # Extract next to the target so moving a volume is a plain rename
+    with resp, tempfile.TemporaryDirectory(
+        prefix=".dvm-restore-", dir=volumes_dir
+    ) as tmpdir:
+        head = resp.read(len(MANIFEST_HEADER))
+        if head != MANIFEST_HEADER:
+            pipe_response_to_tar(resp, head, tmpdir, url, expected)
+            for name in os.listdir(tmpdir):
+                src = os.path.join(tmpdir, name)
+                if not os.path.isdir(src):
+                    continue
+
+                new_name = rename(name)
+                if confirm_target(volumes_dir, name, new_name, force):
+                    replace_target(src, os.path.join(volumes_dir, new_name))
+            return
+
+        entries = read_manifest(resp, head, url, expected)
+        targets = [rename(name) for name, _ in entries]
+        duplicates = sorted({t for t in targets if targets.count(t) > 1})
+        if duplicates:
+            raise click.ClickException(
+                "Several volumes would be restored to: " + ", ".join(duplicates)
+            )
+
+        shards = []
+        for (name, shard_url), new_name in zip(entries, targets):
+            if confirm_target(volumes_dir, name, new_name, force):
+                shards.append((shard_url, name, new_name))
+
+        def restore_shard(shard_url: str, name: str, new_name: str) -> None:
+            stream_http_to_tar(shard_url, tmpdir)
+
+            src = os.path.join(tmpdir, name)
+            if not os.path.isdir(src):
+                raise click.ClickException(
+                    f"Archive {shard_url} does not contain volume '{name}'."
+                )
+            replace_target(src, os.path.join(volumes_dir, new_name))
+
+        run_parallel(restore_shard, shards, jobs)
 
 
 # ---------------------------------------------------------------------------
@@ -185,6 +898,10 @@ class Config(TypedDict):
     endpoint: str
 
 
+# Parsed configs keyed by (path, st_mtime_ns, st_size) of the file they came from
+_config_cache: dict[tuple[str, int, int], Config] = {}
+
+
 def load_config() -> Config:
     """
     Load configuration from ~/.dvm/config.toml.
@@ -200,12 +917,20 @@ def load_config() -> Config:
         endpoint=DEFAULT_TRANSFERSH,
     )
 
-    if not CONFIG_PATH.is_file():
+    try:
+        st = CONFIG_PATH.stat()
+    except OSError:
+        return cfg
+    if not stat.S_ISREG(st.st_mode):
         return cfg
 
+    key = (str(CONFIG_PATH), st.st_mtime_ns, st.st_size)
+    cached = _config_cache.get(key)
+    if cached is not None:
+        return cached.copy()
+
     try:
-        with CONFIG_PATH.open("rb") as f:
-            data = tomllib.load(f)
+        data = tomllib.loads(CONFIG_PATH.read_bytes().decode("utf-8"))
     except Exception as e:
         echo(
             f"Warning: Could not read configuration ({CONFIG_PATH}): {e}",
@@ -222,12 +947,16 @@ def load_config() -> Config:
         if isinstance(endpoint, str) and endpoint:
             cfg["endpoint"] = endpoint
 
+    _config_cache[key] = cfg.copy()
     return cfg
 
 
 def save_config(cfg: Config) -> None:
     """
     Save configuration to ~/.dvm/config.toml (simple TOML write).
+
+    The file is written to a temporary sibling, fsynced and renamed over
+    the old one, so a crash never leaves a torn config behind.
     """
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -239,7 +968,18 @@ def save_config(cfg: Config) -> None:
         "",
     ]
 
-    CONFIG_PATH.write_text("\n".join(content_lines), encoding="utf-8")
+    payload = "\n".join(content_lines).encode("utf-8")
+
+    tmp_path = CONFIG_PATH.with_suffix(".toml.tmp")
+    # 0o600: the endpoint may contain credentials
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, payload)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, CONFIG_PATH)
+    _config_cache.clear()
 
 
 # ---------------------------------------------------------------------------
@@ -313,7 +1053,13 @@ def config_cmd():
     "--all-volumes",
     "-a",
     is_flag=True,
-    help="Backup all Docker volumes (reads names from 'docker volume ls').",
+    help="Backup all Docker volumes (every directory under <docker_root>/volumes).",
+)
+@click.option(
+    "--use-docker-cli",
+    is_flag=True,
+    help="With --all-volumes: list volumes via 'docker volume ls' instead of "
+    "scanning the volumes directory.",
 )
 @click.option(
     "--docker-root",
@@ -335,7 +1081,24 @@ def config_cmd():
     "--output",
     "-o",
     default=None,
-    help="Filename for the archive on transfer.sh (e.g. docker-volumes.tar).",
+    help="Filename for the archive on transfer.sh (e.g. docker-volumes.tar.zst).",
+)
+@click.option(
+    "--compression",
+    "-c",
+    type=click.Choice(COMPRESSION_CHOICES),
+    default="zstd",
+    show_default=True,
+    help="Compress the archive on the fly; 'none'/'raw' skip it (fast LANs).",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Volumes packed and uploaded in parallel, one archive each "
+    f"(default: number of CPUs, at most {MAX_DEFAULT_JOBS}; 1 creates a single "
+    "archive).",
 )
 @click.option(
     "--max-days",
@@ -346,10 +1109,13 @@ def config_cmd():
 def backup(
     volumes: str | list[str],
     all_volumes: bool,
+    use_docker_cli: bool,
     docker_root: str,
     endpoint: str,
     name: Optional[str],
     max_days: Optional[int],
+    compression: str,
+    jobs: Optional[int],
 ) -> None:
     """
     Pack volumes and upload them to transfer.sh.
@@ -365,11 +1131,11 @@ def backup(
 
     volume_names: list[str] = list(volumes)
 
-    if all_volumes:
-        # docker volume ls --format '{{.Name}}'
+    if all_volumes and use_docker_cli:
+        # docker volume ls -q (names only, one per line, no header)
         try:
             result = subprocess.run(
-                ["docker", "volume", "ls", "--format", "{{.Name}}"],
+                ["docker", "volume", "ls", "-q"],
                 check=True,
                 capture_output=True,
                 text=True,
@@ -379,7 +1145,14 @@ def backup(
                 f"Error running 'docker volume ls': {e.stderr.strip()}"
             )
 
-        names = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+        names = result.stdout.split()
+        if not names:
+            raise click.ClickException("No Docker volumes were found.")
+        volume_names = names
+    elif all_volumes:
+        # Docker keeps every volume as a directory under volumes/, no need to
+        # start the docker CLI and ask dockerd for the names
+        names = sorted(list_volume_dirs(volumes_dir))
         if not names:
             raise click.ClickException("No Docker volumes were found.")
         volume_names = names
@@ -389,21 +1162,43 @@ def backup(
             "No volumes specified. Use --volume ... or --all-volumes."
         )
 
+    if not all_volumes or use_docker_cli:
+        # names from the directory scan are known to exist
+        check_volume_dirs(volumes_dir, volume_names)
+    jobs = min(jobs or default_jobs(), len(volume_names))
+
     echo(f"Backing up volumes: {', '.join(volume_names)}")
     echo(f"Using volumes directory: {volumes_dir}")
     echo(f"Endpoint: {endpoint}")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tar_path = os.path.join(tmpdir, "docker-volumes.tar")
-
-        run_tar_create(tar_path, volumes_dir, volume_names)
+    archive_name = name or (
+        "docker-volumes.tar.zst" if compression == "zstd" else "docker-volumes.tar"
+    )
 
-        archive_name = name or "docker-volumes.tar"
-        url = upload_to_transfersh(tar_path, endpoint, archive_name, max_days=max_days)
+    headers: dict[str, str] = {}
+    if max_days is not None:
+        # transfer.sh supports e.g. Max-Days as header (depending on implementation)
+        headers["Max-Days"] = str(max_days)
+
+    if jobs > 1:
+        body = stream_shards_to_http(
+            volumes_dir,
+            volume_names,
+            endpoint,
+            archive_name,
+            headers,
+            compression,
+            jobs,
+        )
+    else:
+        url = f"{endpoint.rstrip('/')}/{archive_name}"
+        body = stream_tar_to_http(volumes_dir, volume_names, url, headers, compression)
+    echo("Upload complete.")
+    echo(f"Response: {body}")
 
-        echo("\nDONE ✅")
-        echo("Use the following link on the target system for 'restore':")
-        stdout(url)
+    echo("\nDONE ✅")
+    echo("Use the following link on the target system for 'restore':")
+    stdout(body)
 
 
 @cli.command()
@@ -419,7 +1214,10 @@ def backup(
     "-r",
     "replacements",
     multiple=True,
-    help="String replacement for volume names, e.g. 'old=new'. Can be specified multiple times.",
+    help="String replacement for volume names, e.g. 'old=new'. Can be specified "
+    "multiple times; all rules apply in one pass to the original name, so "
+    "'-r a=b -r b=c' turns 'a' into 'b', not 'c'. Where rules overlap the "
+    "longest match wins.",
 )
 @click.option(
     "--force",
@@ -427,7 +1225,21 @@ def backup(
     is_flag=True,
     help="Overwrite existing volume directories without asking.",
 )
-def restore(url: str, docker_root: Optional[str], replacements: str | list[str]) -> None:
+@click.option(
+    "--jobs",
+    "-j",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Archives downloaded and extracted in parallel when restoring from "
+    f"a manifest (default: number of CPUs, at most {MAX_DEFAULT_JOBS}).",
+)
+def restore(
+    url: str,
+    docker_root: Optional[str],
+    replacements: str | list[str],
+    force: bool,
+    jobs: Optional[int],
+) -> None:
     """
     Download tar archive from transfer.sh and restore volumes.
 
@@ -445,6 +1257,8 @@ def restore(url: str, docker_root: Optional[str], replacements: str | list[str])
             f"Volumes directory does not exist: {volumes_dir}"
         )
 
+    jobs = jobs or default_jobs()
+
     # Parse replacements: "old=new"
     replace_pairs: list[tuple[str, str]] = []
     for spec in list(replacements):
@@ -459,50 +1273,19 @@ def restore(url: str, docker_root: Optional[str], replacements: str | list[str])
             )
         replace_pairs.append((old, new))
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tar_path = os.path.join(tmpdir, "docker-volumes.tar")
-
-        download_file(url, tar_path)
-
-        if not replace_pairs:
-            run_tar_extract(tar_path, volumes_dir)
-        else:
-            extract_dir = os.path.join(tmpdir, "extract")
-            os.mkdir(extract_dir)
-
-            run_tar_extract(tar_path, extract_dir)
-
-            for name in os.listdir(extract_dir):
-                src = os.path.join(extract_dir, name)
-                if not os.path.isdir(src):
-                    continue
-
-                new_name = name
-                for old, new in replace_pairs:
-                    new_name = new_name.replace(old, new)
-
-                dst = os.path.join(volumes_dir, new_name)
-
-                if os.path.exists(dst):
-                    echo(
-                        f"Warning: Target volume directory already exists: {dst}",
-                    )
-                    if not click.confirm("Overwrite?", default=False):
-                        echo(f"Skipping volume '{name}'.")
-                        continue
-                    echo(f"Overwriting existing volume directory '{dst}'.")
-
-                echo(
-                    f"Volume directory '{name}' -> '{new_name}'",
-                )
-                shutil.move(src, dst)
-
-        echo("\nDONE ✅")
-        echo(
-            f"Volumes have been restored under {volumes_dir}.\n"
-            "Restart Docker and start containers with the corresponding volume names as configured.",
+    if not replace_pairs:
+        stream_http_to_tar(url, volumes_dir, jobs)
+    else:
+        restore_renamed(
+            url, volumes_dir, compile_replacements(replace_pairs), force, jobs
         )
 
+    echo("\nDONE ✅")
+    echo(
+        f"Volumes have been restored under {volumes_dir}.\n"
+        "Restart Docker and start containers with the corresponding volume names as configured.",
+    )
+
 
 if __name__ == "__main__":
     cli()